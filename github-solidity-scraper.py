@@ -5,9 +5,17 @@
 # Its main purpose is to build a local database of Solidity smart contracts and
 # their versions. It is structured in a semi-chronological, readable form.
 
-import os, sys, argparse, shutil, time, signal, re
-import sqlite3, csv
+import os, sys, argparse, shutil, time, signal, re, itertools, hashlib, json
+import sqlite3, csv, threading
+from collections import deque
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import ijson
+import orjson
+import zstandard
 
 # First we need to parse and validate arguments, check environment variables,
 # set up the help text and so on.
@@ -49,9 +57,10 @@ parser.add_argument('--search-forks', dest='forks', action='store_true',
 parser.add_argument('--license-filter', dest='licensed', action='store_true', 
     help='filter the query with a list of open source licenses')
 
-parser.add_argument('--github-token', metavar='TOKEN', 
-    default=os.environ.get('GITHUB_TOKEN'), 
-    help='''personal access token for GitHub 
+parser.add_argument('--github-token', metavar='TOKEN',
+    default=os.environ.get('GITHUB_TOKEN'),
+    help='''personal access token for GitHub, or a comma-separated list of
+    tokens to rotate through
     (by default, the environment variable GITHUB_TOKEN is used)''')
 
 args = parser.parse_args()
@@ -74,7 +83,25 @@ Do you want to run the program without a token (this will slow the program down)
         time.sleep(2)
     else:
         sys.exit("\nYou can specifiy a personal access token for GitHub using the '--github-token' argument.")
-            
+
+# A single token caps us at 5000 API requests per hour. To lift that ceiling,
+# '--github-token' also accepts a comma-separated list of tokens which we
+# rotate through request by request, scaling the aggregate allowance with the
+# number of tokens. For every token we remember how much of its allowance is
+# left (taken from the X-RateLimit headers of its last response) so we can
+# skip tokens that are nearly used up and only wait when all are exhausted.
+
+tokens = ([t.strip() for t in args.github_token.split(',') if t.strip()]
+    if args.github_token else [])
+token_cycle = itertools.cycle(tokens)
+token_remaining = {}
+token_reset = {}
+
+# Neither the hourly allowance nor a token's auth header ever changes during a
+# run, so both are computed once here instead of on every request.
+
+hourly_allowance = 60 if not tokens else 5000 * len(tokens)
+token_headers = {t: {'Authorization': f'token {t}'} for t in tokens}
 
 #-------------------------------------------------------------------------------
 
@@ -140,13 +167,32 @@ print('                 ┌────────────┬────
 print('                 │  pop repo  │  sam repo  │  sam file  │ sam commit │')
 print('                 ├────────────┼────────────┼────────────┼────────────┤')
 
+# The footer and status are redrawn after every repo, which used to mean a
+# dozen individual print calls (and with a line-buffered terminal, a dozen
+# flushes) per redraw. Each redraw is now assembled into one string and
+# written with a single call, and the actual flush to the terminal happens at
+# most twice a second. When stdout is not a terminal the live updates are
+# skipped altogether; only the permanent table rows are emitted.
+
+UI_TTY = sys.stdout.isatty()
+if UI_TTY:
+    sys.stdout.reconfigure(line_buffering=False)
+last_flush = 0.0
+
+def flush_ui():
+    global last_flush
+    now = time.time()
+    if now - last_flush >= 0.5:
+        sys.stdout.flush()
+        last_flush = now
+
 # Now we define some functions to print information about the current stratum.
 # By default, this will simply add a new line to the output. However, to be able
 # to show live progress, there is also an option to overwrite the current line.
 
 def print_stratum(overwrite=False):
-    if overwrite:
-        sys.stdout.write('\033[F\r\033[J')
+    if overwrite and not UI_TTY:
+        return
     if strat_first == strat_last:
         size = '%d' % strat_first
     else:
@@ -156,8 +202,11 @@ def print_stratum(overwrite=False):
     sam_file_str = str(sam_file) if sam_file > -1 else ''
     sam_comit_str = str(sam_comit) if sam_comit > -1 else ''
     per = '%6.2f%%' % (sam_repo/pop_repo*100) if pop_repo > 0 else ''
-    print('%16s │ %10s │ %10s │ %10s │ %10s │ %6s' % (size, pop_str, sam_repo_str, 
-        sam_file_str, sam_comit_str, per))
+    buf = '\033[F\r\033[J' if overwrite else ''
+    buf += '%16s │ %10s │ %10s │ %10s │ %10s │ %6s\n' % (size, pop_str,
+        sam_repo_str, sam_file_str, sam_comit_str, per)
+    sys.stdout.write(buf)
+    flush_ui()
 
 # Another function will print the footer of the table, including summary
 # statistics and the status message. Here we provide a separate function to
@@ -166,26 +215,33 @@ def print_stratum(overwrite=False):
 status_msg = ''
 
 def print_footer():
+    if not UI_TTY:
+        return
     if args.min_size == args.max_size:
         size = '%d' % args.min_size
     else:
         size = '%d .. %d' % (args.min_size, args.max_size)
-    ratelimit = 60 if not args.github_token else 5000
+    ratelimit = hourly_allowance
     tot_sam_repo_str = str(total_sam_repo) if total_sam_repo > -1 else ''
     tot_sam_file_str = str(total_sam_file) if total_sam_file > -1 else ''
     tot_sam_comit_str = str(total_sam_comit) if total_sam_comit > -1 else ''
-    print('                 ├────────────┼────────────┼────────────┼────────────┤')
-    print('                 │  pop repo  │  sam repo  │  sam file  │ sam commit │')
-    print('                 └────────────┴────────────┴────────────┴────────────┘')
-    print('%16s   %10s   %10s   %10s   %10s   %6s' % (size, '', tot_sam_repo_str,
-        tot_sam_file_str, tot_sam_comit_str, ''))
-    print()
-    print('Current queried license: ', current_license) if args.licensed else print()
-    print('Current GitHub ratelimit: %d / ~%d' % (rate_used, ratelimit))
-    print()
-    print(status_msg)
+    buf = '\n'.join([
+        '                 ├────────────┼────────────┼────────────┼────────────┤',
+        '                 │  pop repo  │  sam repo  │  sam file  │ sam commit │',
+        '                 └────────────┴────────────┴────────────┴────────────┘',
+        '%16s   %10s   %10s   %10s   %10s   %6s' % (size, '', tot_sam_repo_str,
+            tot_sam_file_str, tot_sam_comit_str, ''),
+        '',
+        'Current queried license:  %s' % current_license if args.licensed else '',
+        'Current GitHub ratelimit: %d / ~%d' % (rate_used, ratelimit),
+        '',
+        status_msg]) + '\n'
+    sys.stdout.write(buf)
+    flush_ui()
 
 def clear_footer():
+    if not UI_TTY:
+        return
     sys.stdout.write(f'\033[9F\r\033[J')
 
 # For convenience, we also have function for just updating the status message.
@@ -195,72 +251,258 @@ def update_status(msg):
     global status_msg
     old_msg = status_msg
     status_msg = msg
-    sys.stdout.write('\033[F\r\033[J')
-    print(status_msg)
+    if UI_TTY:
+        sys.stdout.write('\033[F\r\033[J' + status_msg + '\n')
+        flush_ui()
     return old_msg
 
 #-------------------------------------------------------------------------------
 
+# All our HTTP traffic goes to just two hosts: api.github.com and
+# raw.githubusercontent.com. Instead of opening a fresh TCP+TLS connection for
+# every single request, we use one requests.Session per host so that urllib3's
+# connection pooling keeps the connections alive and we pay the TLS handshake
+# only once. The sessions also retry transient gateway errors with a small
+# backoff. The authorization header is set per request, since we rotate
+# through the configured tokens.
+
+adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]))
+
+api_session = requests.Session()
+api_session.mount('https://', adapter)
+
+raw_session = requests.Session()
+raw_session.mount('https://', adapter)
+
+# Downloads from raw.githubusercontent.com are not rate limited and consist
+# almost entirely of waiting on the network, so we fan them out over a small
+# pool of worker threads. The session above is thread-safe and its connection
+# pool is sized to match.
+
+raw_pool = ThreadPoolExecutor(max_workers=12)
+
 # To access the GitHub API, we define a little helper function that makes an
 # authorized GET request and throttles the number of requests per second so as
 # not to run afoul of GitHub's rate limiting. Should a rate limiting error occur
 # nonetheless, the function waits the appropriate amount of time before
 # automatically retrying the request.
 
-def get(url, params={}):
+# Picking a token for the next request is a small helper of its own: it walks
+# the rotation until it finds a token with enough of its allowance left, or
+# returns None when all of them are (close to) exhausted.
+
+def next_token():
+    for _ in range(len(tokens)):
+        token = next(token_cycle)
+        if token_remaining.get(token, 5000) > 50:
+            return token
+    return None
+
+# Instead of sleeping a fixed interval before every request, we keep a sliding
+# window of the timestamps of the requests made in the last hour and only wait
+# when one more request would exceed the hourly allowance. As long as network
+# round-trips and content downloads already keep the request rate below the
+# allowance, the throttle adds no wait at all.
+
+request_times = deque()
+
+def throttle():
+    now = time.time()
+    while request_times and now - request_times[0] >= 3600:
+        request_times.popleft()
+    if len(request_times) >= hourly_allowance:
+        time.sleep(3600 - (now - request_times[0]) + 1)
+    request_times.append(time.time())
+
+# Retries are handled with an explicit loop rather than by calling 'get'
+# recursively, so a long rate-limit storm can't pile up stack frames: the
+# rate-limit handler just sleeps, and the loop issues the request again. The
+# loop is bounded; after ten rate-limited attempts the request is given up
+# and the error raised to the caller. Note that GitHub also answers 403 for
+# reasons other than rate limiting (e.g. DMCA-blocked repos), so only
+# responses that actually report an exhausted allowance or mention the rate
+# limit are retried; any other 403 is logged and raised like any other error.
+
+# GitHub serves an ETag with every API response, and a conditional request
+# that answers 304 Not Modified does not count against the rate limit. We
+# remember the ETag and body of past responses in the 'etag_cache' table, send
+# If-None-Match, and on a 304 replay the stored body as if it were a fresh
+# 200 response. A resumed run can therefore re-validate strata and commit
+# lists it has already seen without spending any of its allowance. Streamed
+# responses (the big trees) are not cached, since keeping their bodies around
+# would defeat the point of streaming them.
+
+def get(url, params=None, stream=False):
     global api_calls, rate_used
-    if args.throttle:
-        sleep = 60 if not args.github_token else 0.72
-        time.sleep(sleep)
-    auth_headers = {} if not args.github_token else {'Authorization': f'token {args.github_token}'}
-    try:
-        res = requests.get(url, params, headers=auth_headers)
-    except requests.ConnectionError:
-        print("\nERROR :: There seems to be a problem with your internet connection.")
-        return signal_handler(0,0)
-    api_calls += 1
-    rate_used = (int(res.headers.get('X-RateLimit-Used')) if
-        res.headers.get('X-RateLimit-Used') != None else 0)
-    if res.status_code == 403:
-        clear_footer()
-        print_footer()
-        return handle_rate_limit_error(res)
-    else:
+    cache_key = url if not params else url + '?' + urlencode(params)
+    for attempt in range(10):
+        if args.throttle:
+            throttle()
+        token = next_token()
+        if tokens and token is None:
+            # Every token is exhausted, so wait until the earliest one resets.
+            t = max(0, int(min(token_reset.values(), default=time.time() + 60)
+                - time.time())) + 1
+            old_msg = update_status(f'All tokens exhausted. Retrying after {t} seconds...')
+            sys.stdout.flush()
+            time.sleep(t)
+            token_remaining.clear()
+            update_status(old_msg)
+            token = next_token()
+        if args.throttle and token is not None and 0 < token_remaining.get(token, 5000) < 100:
+            # The token is close to its limit; spread the remaining requests
+            # evenly over the time left until it resets.
+            wait = ((token_reset.get(token, time.time()) - time.time())
+                / token_remaining[token])
+            if wait > 0:
+                time.sleep(wait)
+        cached = None if stream else db.execute(
+            "select etag, body, link from etag_cache where url = ?",
+            (cache_key,)).fetchone()
+        headers = token_headers.get(token)
+        if cached:
+            headers = dict(headers or {})
+            headers['If-None-Match'] = cached[0]
+        try:
+            res = api_session.get(url, params=params, headers=headers,
+                timeout=30, stream=stream)
+        except requests.ConnectionError:
+            # Raise to the caller instead of shutting down from in here: the
+            # request may run inside the per-repo transaction, whose exit
+            # would then operate on a closed connection. The callers treat a
+            # failed fetch like any other error and skip the resource.
+            print("\nERROR :: There seems to be a problem with your internet connection.")
+            raise
+        api_calls += 1
+        rate_used = (int(res.headers.get('X-RateLimit-Used')) if
+            res.headers.get('X-RateLimit-Used') != None else 0)
+        if token is not None:
+            remaining = res.headers.get('X-RateLimit-Remaining')
+            if remaining is not None:
+                token_remaining[token] = int(remaining)
+            reset = res.headers.get('X-RateLimit-Reset')
+            if reset is not None:
+                token_reset[token] = int(reset)
+        if res.status_code == 304 and cached:
+            # Nothing changed; hand back the stored body as a 200 response.
+            replay = requests.Response()
+            replay.status_code = 200
+            replay.url = res.url
+            replay.encoding = 'utf-8'
+            replay._content = cached[1]
+            replay.headers = res.headers.copy()
+            if cached[2]:
+                replay.headers['Link'] = cached[2]
+            return replay
+        if res.status_code == 403 and (
+                res.headers.get('X-RateLimit-Remaining') == '0'
+                or 'rate limit' in res.text.lower()):
+            clear_footer()
+            print_footer()
+            # A rate-limited token is marked as spent; if another token still
+            # has allowance left we retry with that one right away and only
+            # wait when the whole rotation is exhausted.
+            if token is not None:
+                token_remaining[token] = 0
+                if next_token() is not None:
+                    continue
+            handle_rate_limit_error(res)
+            continue
         if res.status_code != 200:
             handle_log_response(res)
         res.raise_for_status()
+        if not stream and 'ETag' in res.headers:
+            db.execute('''INSERT OR REPLACE INTO etag_cache (url, etag, body, link)
+                VALUES (?,?,?,?)''', (cache_key, res.headers['ETag'],
+                res.content, res.headers.get('Link')))
         return res
+    # Still rate limited after ten attempts; give up on this request and let
+    # the caller skip the resource.
+    res.raise_for_status()
 
 def handle_rate_limit_error(res):
     t = res.headers.get('X-RateLimit-Reset')
     if t is not None:
         t = max(0, int(int(t) - time.time()))
-    else: 
+    else:
         t = int(res.headers.get('Retry-After', 60))
     err_msg = f'Exceeded rate limit. Retrying after {t} seconds...'
-    if not args.github_token:
+    if not tokens:
         err_msg += ' Try running the script with a GitHub TOKEN.'
     old_msg = update_status(err_msg)
+    sys.stdout.flush()
     time.sleep(t)
     update_status(old_msg)
-    return get(res.url)
+
+# The GraphQL endpoint lets us bundle many lookups into a single POST request.
+# We use it to fetch a file's commit history together with the file contents
+# at each commit (see the commit download section below). The helper shares
+# the throttle and the token rotation with 'get'; GraphQL always requires a
+# token, so when no token has allowance left we raise and let the caller fall
+# back to the REST path, whose 'get' knows how to wait for a reset.
+
+def graphql(query, variables):
+    global api_calls, rate_used
+    if args.throttle:
+        throttle()
+    token = next_token()
+    if token is None:
+        raise requests.HTTPError('all tokens exhausted')
+    res = api_session.post('https://api.github.com/graphql',
+        json={'query': query, 'variables': variables},
+        headers=token_headers[token], timeout=30)
+    api_calls += 1
+    rate_used = (int(res.headers.get('X-RateLimit-Used')) if
+        res.headers.get('X-RateLimit-Used') != None else 0)
+    remaining = res.headers.get('X-RateLimit-Remaining')
+    if remaining is not None:
+        token_remaining[token] = int(remaining)
+    reset = res.headers.get('X-RateLimit-Reset')
+    if reset is not None:
+        token_reset[token] = int(reset)
+    res.raise_for_status()
+    payload = orjson.loads(res.content)
+    if 'errors' in payload:
+        raise requests.HTTPError('GraphQL: '
+            + payload['errors'][0].get('message', 'unknown error'), response=res)
+    return payload['data']
 
 # In order to reduce the amount of GitHub API calls further we use the raw content API
 # from GitHub to request the content of the single commits. This also reduces the need
 # to throttle and hence makes the script theoretically faster. We define a function that
-# helps to request data from the 'raw.githubusercontent.com/' API.
+# helps to request data from the 'raw.githubusercontent.com/' API. Note that this
+# function runs on the worker threads of the download pool, so it must not touch
+# the terminal UI or sleep: it only raises on failure and lets the error
+# propagate to the dispatching loop on the main thread, which logs the response
+# and skips the affected commit.
 
 def get_content(url):
-    try:
-        res = requests.get(url)
-    except requests.ConnectionError:
-        print("\nERROR :: There seems to be a problem with your internet connection.")
-        return signal_handler(0,0)
-    if res.status_code != 200:
-        handle_log_response(res)
+    res = raw_session.get(url, timeout=30)
     res.raise_for_status()
     return res
 
+# Hashing a content blob, scanning it for the compiler pragma and compressing
+# it for storage are the only CPU-bound work per commit. All three happen on
+# the worker threads of the download pool, so by the time a result reaches the
+# main thread all that is left to do is bind parameters and execute SQL.
+# 'fetch_and_parse' combines the download and the parsing into one worker
+# task. Solidity source compresses roughly an order of magnitude with zstd,
+# which shrinks the database and its page I/O accordingly. Compressor objects
+# are not thread safe, so every worker thread keeps its own.
+
+tls = threading.local()
+
+def parse_content(body, text):
+    if not hasattr(tls, 'cctx'):
+        tls.cctx = zstandard.ZstdCompressor(level=7)
+    return blob_sha(body), find_compiler_version(text), tls.cctx.compress(body)
+
+def fetch_and_parse(url):
+    res = get_content(url)
+    sha, version, packed = parse_content(res.content, res.text)
+    return res.content, packed, sha, version
+
 # This helper function can be used to write information on the Response from a request 
 # into a log-file (default: log.txt).
 
@@ -270,7 +512,14 @@ def handle_log_response(res,file="log.txt"):
     logger = open(file, "a")
     logging_str =  "\n\nTime: " + time.strftime("%m/%d/%Y, %H:%M:%S", time.localtime()) 
     logging_str += "\nRequest: " + str(res.url) + "\nStatus: "+ str(res.status_code)
-    logging_str += "\nMessage: " + res.json()['message'] if res.status_code != 200 else ''
+    if res.status_code != 200:
+        # The GitHub API wraps its errors in JSON, but other hosts (e.g.
+        # raw.githubusercontent.com) answer with plain text bodies.
+        try:
+            message = orjson.loads(res.content)['message']
+        except Exception:
+            message = res.text.strip()
+        logging_str += "\nMessage: " + message
     logger.write(logging_str)
     logger.close()
     time.sleep(1.5)
@@ -292,7 +541,15 @@ def search(a,b,order='asc',license="no"):
 
 #-------------------------------------------------------------------------------
 
-# To download all repos/files/commits returned by a code search (up to the limit 
+# The filters below run for every entry of a repository tree (up to 100,000
+# per repo) and for every commit's file content, so we compile their regexes
+# once up front instead of going through re's pattern cache on every call.
+
+SOL_RE = re.compile(r'\w\.sol$')
+NAME_RE = re.compile(r'[\w-]+?(?=\.)')
+PRAGMA_RE = re.compile(r'pragma solidity [<>^]?=?\s*([\d.]+)')
+
+# To download all repos/files/commits returned by a code search (up to the limit
 # of 1000 repo search results imposed by GitHub), we need to deal with pagination.
 # On each page, we loop through all items and add them and their metadata to our
 # results database (which will be set up in the next section), provided they're 
@@ -315,7 +572,7 @@ def download_all_repos(res):
         update_status('Getting next page of search results...')
         global pop_repo
         res = get(res.links['next']['url'])
-        pop2 = res.json()['total_count'] + current_cumulative_pop
+        pop2 = orjson.loads(res.content)['total_count'] + current_cumulative_pop
         pop_repo = max(pop_repo,pop2)
         download_repos_from_page(res)
         if sam_repo >= pop_repo:
@@ -325,23 +582,61 @@ def download_all_repos(res):
 
 def download_repos_from_page(res):
     update_status('Get list of files in repository...')
-    for repo in res.json()['items']:
-        if not known_repo(repo):
+    for repo in orjson.loads(res.content)['items']:
+        # The search result already tells us when a repo can't have any
+        # Solidity files (size 0 or no default branch), and the failed_repo
+        # table remembers repos whose tree request failed for good on an
+        # earlier run. Both are skipped before spending an API call on them.
+        if (repo.get('size', 0) == 0 or not repo.get('default_branch')
+                or repo['id'] in failed_repos):
+            continue
+        # Each repo's worth of inserts happens inside a single transaction
+        # (sqlite3's connection context manager issues BEGIN/COMMIT), so the
+        # database only has to sync to disk once per repo instead of once
+        # per inserted row.
+        with db:
+            # Thanks to the UNIQUE constraints in the schema, inserting is
+            # also our duplicate check: 'INSERT OR IGNORE' simply skips rows
+            # that are already present, so there is no need for a SELECT
+            # round-trip before every insert. A repo that was already in the
+            # database still gets its files processed, in case a previous
+            # run was interrupted halfway through it.
             insert_repo(repo)
             try:
-                res = get("https://api.github.com/repos/" + repo["full_name"] 
-                        + "/git/trees/" + repo["default_branch"] + "?recursive=1")
+                res = get("https://api.github.com/repos/" + repo["full_name"]
+                        + "/git/trees/" + repo["default_branch"] + "?recursive=1",
+                        stream=True)
+            except requests.HTTPError as e:
+                # A 404/409 here won't fix itself; remember the repo so the
+                # next resume skips it without a request.
+                if (e.response is not None
+                        and e.response.status_code in (404, 409)):
+                    insert_failed_repo(repo['id'])
+                continue
             except Exception:
                 continue
-            
-            for file in res.json()['tree']:
-                if(file['type'] == "blob" and bool(re.search(fr'\w\.sol$', file['path']))):
-                    # Extract the file name from the path using regex
-                    name_re = re.search(r'[\w-]+?(?=\.)', file['path'])
-                    file['name'] = name_re.group(0) if name_re != None else file['path']
-                    if not known_file(file, repo['id']):
-                        file_id = insert_file(file, repo['id'])
-                        download_all_commits(repo, file, file_id)
+
+            # The tree response can hold up to 100,000 entries in a 7 MB body.
+            # We stream it through ijson and keep only the Solidity files, so
+            # the full list of entries is never materialized in memory. A
+            # cheap string check weeds out non-Solidity paths before the regex
+            # confirms there is a word character in front of '.sol'.
+            try:
+                res.raw.decode_content = True
+                sol_files = [file for file in ijson.items(res.raw, 'tree.item')
+                    if file['type'] == "blob" and file['path'].endswith('.sol')
+                        and SOL_RE.search(file['path'])]
+            except Exception:
+                continue
+            finally:
+                res.close()
+
+            for file in sol_files:
+                # Extract the file name from the path using regex
+                name_re = NAME_RE.search(file['path'])
+                file['name'] = name_re.group(0) if name_re != None else file['path']
+                file_id = insert_file(file, repo['id'])
+                download_all_commits(repo, file, file_id)
 
         clear_footer()
         print_stratum(overwrite=True)
@@ -350,14 +645,46 @@ def download_repos_from_page(res):
             return
 
 # DOWNLOAD COMMITS
-# For each of the files a list of commits is requested from the Github API 
-# using the path as query on the commits endpoint.
-# The list of commits will again be paginated (with 100 elements per page).
-# Hence we loop over all pages and each of the commits on the pages. For a
-# commit the file content is then downloaded from the Raw Github API that 
-# has no rate limit.
+# For each of the files the entire commit history has to be collected. With a
+# token we use the GraphQL API for that: one POST returns a whole page of the
+# commit history, and a second kind of POST fetches the file contents at up to
+# 50 commits at once via aliased blob lookups. That collapses what used to be
+# one commits-list request plus one raw download per commit into a handful of
+# requests per file. Without a token (GraphQL requires authentication), or if
+# the GraphQL query fails, we fall back to the REST commits endpoint and
+# download the contents from the Raw Github API, which has no rate limit.
+
+HISTORY_QUERY = '''
+query ($owner: String!, $name: String!, $branch: String!, $path: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    object(expression: $branch) {
+      ... on Commit {
+        history(path: $path, first: 100, after: $cursor) {
+          pageInfo { hasNextPage endCursor }
+          nodes {
+            oid
+            message
+            committedDate
+            parents(first: 10) { nodes { oid } }
+          }
+        }
+      }
+    }
+  }
+}
+'''
 
 def download_all_commits(repo, file, file_id):
+    # One query up front gives us all commit shas we already have for this
+    # file, so the per-commit loops below can check a set instead of issuing
+    # a SELECT round-trip for every single commit.
+    known_shas = {row[0] for row in
+        db.execute("select sha from comit where file_id = ?", (file_id,))}
+    if tokens:
+        try:
+            return download_all_commits_graphql(repo, file, file_id, known_shas)
+        except Exception:
+            pass
     try:
         # Get the list of commits for this file
         commits_url = repo['commits_url'][:-6].replace('#', '%23')
@@ -365,42 +692,138 @@ def download_all_commits(repo, file, file_id):
     except Exception:
         return
     download_commits_from_page(commits_res, repo['full_name'],
-                                file['path'], file_id)
+                                file['path'], file_id, known_shas)
     while 'next' in commits_res.links:
         update_status('Getting next page of commits...')
         commits_res = get(commits_res.links['next']['url'])
         download_commits_from_page(commits_res, repo['full_name'],
-                                    file['path'], file_id)
+                                    file['path'], file_id, known_shas)
+    update_status('')
+
+
+def download_all_commits_graphql(repo, file, file_id, known_shas):
+    owner, name = repo['full_name'].split('/', 1)
+    variables = {'owner': owner, 'name': name,
+        'branch': repo['default_branch'], 'path': file['path'], 'cursor': None}
+
+    # First walk the commit history pages and collect the commits we don't
+    # have yet.
+    new_commits = []
+    while True:
+        history = graphql(HISTORY_QUERY, variables)['repository']['object']['history']
+        new_commits += [n for n in history['nodes'] if n['oid'] not in known_shas]
+        if not history['pageInfo']['hasNextPage']:
+            break
+        variables['cursor'] = history['pageInfo']['endCursor']
+
+    # Then fetch the file contents at those commits, 50 blobs per request
+    # through aliased object lookups.
+    update_status('Downloading %d commits...' % len(new_commits))
+    for batch_start in range(0, len(new_commits), 50):
+        batch = new_commits[batch_start:batch_start+50]
+        aliases = ' '.join(
+            'c%d: object(expression: %s) { ... on Blob { text isTruncated } }'
+            % (i, json.dumps(node['oid'] + ':' + file['path']))
+            for i, node in enumerate(batch))
+        blobs = graphql('query ($owner: String!, $name: String!) '
+            '{ repository(owner: $owner, name: $name) { ' + aliases + ' } }',
+            {'owner': owner, 'name': name})['repository']
+        pending = []
+        for i, node in enumerate(batch):
+            blob = blobs['c%d' % i]
+            if blob is None or blob.get('text') is None or blob.get('isTruncated'):
+                # Binary or oversized blobs come back empty over GraphQL;
+                # those few we still fetch from the raw content API.
+                try:
+                    content_res = get_content('https://raw.githubusercontent.com/'
+                        + repo['full_name'] + '/' + node['oid'] + '/' + file['path'])
+                except requests.HTTPError as e:
+                    if e.response is not None:
+                        handle_log_response(e.response)
+                    continue
+                except Exception:
+                    continue
+                body, text = content_res.content, content_res.text
+            else:
+                text = blob['text']
+                body = text.encode()
+            # Reshape the GraphQL node to the REST commit layout that the
+            # insert helper expects.
+            commit = {'sha': node['oid'], 'commit':
+                {'message': node['message'],
+                 'committer': {'date': node['committedDate']}}}
+            parents = [p['oid'] for p in node['parents']['nodes']]
+            pending.append((commit, body, text, parents))
+            known_shas.add(node['oid'])
+        # Hand the hashing, pragma scanning and compression of the whole
+        # batch to the worker pool before inserting.
+        parse_futures = [raw_pool.submit(parse_content, body, text)
+            for _, body, text, _ in pending]
+        completed = []
+        for (commit, body, text, parents), parse in zip(pending, parse_futures):
+            sha, version, packed = parse.result()
+            completed.append((commit, body, packed, sha, version, parents))
+        insert_commits(completed, file_id)
     update_status('')
 
 
-def download_commits_from_page(commits_res, repo_full_name, file_path, file_id):
-    count_commits = str(len(commits_res.json())) if len(commits_res.json()) < 100 else "100+"
+def download_commits_from_page(commits_res, repo_full_name, file_path, file_id, known_shas):
+    # Decode the response body once with orjson, which parses the raw bytes
+    # considerably faster than the stdlib parser behind .json().
+    commits = orjson.loads(commits_res.content)
+    count_commits = str(len(commits)) if len(commits) < 100 else "100+"
     update_status('Downloading ' + count_commits + ' commits...')
-    for commit in commits_res.json():
-        if not known_commit(commit, file_id):
-            try:
-                content_res = get_content("https://raw.githubusercontent.com/" +
-                    repo_full_name + "/" + commit['sha'] + "/" + file_path)
-            except Exception:
-                continue
 
-            # Extract only shas of parents from api response
-            parents = []
-            for p in commit['parents']:
-                parents.append(p['sha'])
-            insert_commit(commit, content_res, parents, file_id)    
+    # The content downloads are dispatched to the worker pool so their network
+    # round-trips overlap. The database inserts happen here on the main thread
+    # as the results come in, since the sqlite3 connection must not be shared
+    # across threads.
+    new_commits = [c for c in commits if c['sha'] not in known_shas]
+    futures = {raw_pool.submit(fetch_and_parse, "https://raw.githubusercontent.com/" +
+        repo_full_name + "/" + c['sha'] + "/" + file_path): c for c in new_commits}
+    completed = []
+    for future in as_completed(futures):
+        commit = futures[future]
+        try:
+            body, packed, sha, version = future.result()
+        except requests.HTTPError as e:
+            if e.response is not None:
+                handle_log_response(e.response)
+            continue
+        except Exception:
+            continue
+
+        # Extract only shas of parents from api response
+        parents = []
+        for p in commit['parents']:
+            parents.append(p['sha'])
+        completed.append((commit, body, packed, sha, version, parents))
+        known_shas.add(commit['sha'])
+    insert_commits(completed, file_id)
 
 #-------------------------------------------------------------------------------
 
 # This is a good place to open the connection to the results database, or create
 # one if it doesn't exist yet. The database schema is similar to the GitHub API
 # response schema. Our 'insert_repo', 'insert_file' and 'insert_comit' functions
-# help to store the items in the database respectively. 'commit' is a reserved 
-# keyword in sqlite, therefore the tablename is 'comit'. We also increase our 
-# counter for the sample sizes after each insertion.
+# help to store the items in the database respectively. 'commit' is a reserved
+# keyword in sqlite, therefore the tablename is 'comit'. We also increase our
+# counter for the sample sizes after each insertion. Lookups by path/repo_id
+# and sha/file_id are backed by the indexes the UNIQUE constraints create; for
+# lookups by repository full name we add an explicit index so they stay
+# O(log N) instead of scanning the whole repo table.
+
+# A note on write performance: the insert helpers below deliberately do not
+# commit. All rows belonging to one repo are written inside a single
+# transaction (see 'download_repos_from_page'), which means one disk sync per
+# repo rather than one per row. The WAL journal and relaxed synchronous mode
+# further reduce the disk traffic per commit without risking corruption.
 
 db = sqlite3.connect(args.database)
+db.isolation_level = 'DEFERRED'
+db.execute('PRAGMA journal_mode=WAL')
+db.execute('PRAGMA synchronous=NORMAL')
+db.execute('PRAGMA temp_store=MEMORY')
 db.executescript('''
     CREATE TABLE IF NOT EXISTS repo 
     ( repo_id INTEGER PRIMARY KEY
@@ -421,23 +844,54 @@ db.executescript('''
     , FOREIGN KEY (repo_id) REFERENCES repo(repo_id)
     , UNIQUE(path,repo_id)
     );
+    CREATE TABLE IF NOT EXISTS content
+    ( sha TEXT PRIMARY KEY
+    , body BLOB NOT NULL
+    );
     CREATE TABLE IF NOT EXISTS comit
     ( comit_id INTEGER PRIMARY KEY
     , sha TEXT NOT NULL
     , message TEXT NOT NULL
     , size INTEGER NOT NULL
     , created DATETIME DEFAULT CURRENT_TIMESTAMP
-    , content TEXT NOT NULL
+    , content_sha TEXT NOT NULL
     , compiler_version TEXT NOT NULL
     , parents TEXT NOT NULL
     , file_id INTEGER NOT NULL
+    , FOREIGN KEY (content_sha) REFERENCES content(sha)
     , FOREIGN KEY (file_id) REFERENCES file(file_id)
     , UNIQUE(sha,file_id)
     );
+    CREATE TABLE IF NOT EXISTS failed_repo
+    ( repo_id INTEGER PRIMARY KEY
+    );
+    CREATE TABLE IF NOT EXISTS etag_cache
+    ( url TEXT PRIMARY KEY
+    , etag TEXT NOT NULL
+    , body BLOB NOT NULL
+    , link TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_repo_fullname ON repo(full_name);
+    CREATE INDEX IF NOT EXISTS idx_comit_file ON comit(file_id);
     ''')
 
+# Some repos can never yield a tree: they were emptied, renamed their default
+# branch, or disappeared, and their tree request fails with 404/409. We record
+# those in the 'failed_repo' table so resumed runs don't spend an API call on
+# them again, and keep the ids in a set for cheap lookups during this run.
+
+failed_repos = {row[0] for row in db.execute("select repo_id from failed_repo")}
+
+def insert_failed_repo(repo_id):
+    db.execute("INSERT OR IGNORE INTO failed_repo (repo_id) VALUES (?)", (repo_id,))
+    failed_repos.add(repo_id)
+
+# 'INSERT OR IGNORE' tells us through the cursor's rowcount whether a row was
+# actually inserted or silently skipped as a duplicate, so we only count
+# genuinely new items towards the sample sizes.
+
 def insert_repo(repo):
-    db.execute('''
+    local_cur = db.execute('''
         INSERT OR IGNORE INTO repo 
             ( repo_id, name, full_name, description, url, fork
             , owner_id, owner_login
@@ -453,13 +907,15 @@ def insert_repo(repo):
         , repo['owner']['id']
         , repo['owner']['login']
         ))
-    db.commit()
+    if local_cur.rowcount == 0:
+        return
     global sam_repo, total_sam_repo
     sam_repo += 1
     total_sam_repo += 1
 
 # When inserting a file we check the file_id after insertion from the database
-# cursor and return it for further computations.
+# cursor and return it for further computations. If the file was already known
+# (the insert was ignored), one targeted lookup fetches its existing id.
 
 def insert_file(file,repo_id):
     local_cur = db.execute('''
@@ -472,60 +928,75 @@ def insert_file(file,repo_id):
         , file['sha']
         , repo_id
         ))
+    if local_cur.rowcount == 0:
+        cur = db.execute("select file_id from file where path = ? and repo_id = ?",
+            (file['path'], repo_id))
+        return cur.fetchone()[0]
     file_id = local_cur.lastrowid
-    db.commit()
     global sam_file, total_sam_file
     sam_file += 1
     total_sam_file += 1
     return file_id
 
+# Many commits touch a file without changing it, or only one of several files
+# in the repo, so the exact same file content shows up over and over again.
+# Instead of storing a copy per commit, the contents live in the 'content'
+# table keyed by their git blob sha (sha1 over 'blob <len>\\0<body>', the same
+# id git itself uses) and the comit rows just reference them. The bodies are
+# stored zstd-compressed (decompress with the zstandard package when reading).
+# An in-memory set of the shas stored so far lets us skip the database
+# entirely for contents we have already seen in this run.
+
+content_cache = set()
+
+def blob_sha(body):
+    return hashlib.sha1(b'blob ' + str(len(body)).encode() + b'\0' + body).hexdigest()
+
+def insert_content(sha, packed):
+    if sha not in content_cache:
+        db.execute("INSERT OR IGNORE INTO content (sha, body) VALUES (?,?)",
+            (sha, packed))
+        content_cache.add(sha)
+    return sha
+
+# Commits arrive in batches (a page of the history, or one blob-lookup batch),
+# so they are also inserted as a batch: one executemany per batch instead of
+# preparing and running a statement per row. Each entry is a tuple of the
+# commit, the raw and the compressed content, its blob sha and compiler
+# version (all computed on the worker threads), and the list of parent shas.
 # In order to get the byte size of the file content we check the length of the
-# content of the response object. The timestamp is stored as the string directly
-# from the API response, since sqlite can't store time objects anyway.
-# The parent field stores a list of git_shas that correspond to the parent commits.
-
-def insert_commit(commit,content_res,parents,file_id):
-    db.execute('''
-        INSERT OR IGNORE INTO comit
-            (sha, message, size, created, content, compiler_version, parents, file_id)
-        VALUES (?,?,?,?,?,?,?,?)
-        ''',
+# body. The timestamp is stored as the string directly from the API response,
+# since sqlite can't store time objects anyway. The parent field stores the
+# git_shas of the parent commits as a comma-separated string (the shas are
+# plain hex, so splitting on ',' gets the list back). The cursor's rowcount
+# tells us how many rows were genuinely new.
+
+def insert_commits(batch, file_id):
+    rows = [
         ( commit['sha']
         , commit['commit']['message']
-        , len(content_res.content)
+        , len(body)
         , commit['commit']['committer']['date']
-        , content_res.text
-        , find_compiler_version(content_res.text)
-        , str(parents)
+        , insert_content(sha, packed)
+        , version
+        , ','.join(parents)
         , file_id
-        ))
-    db.commit()
+        ) for commit, body, packed, sha, version, parents in batch]
+    local_cur = db.executemany('''
+        INSERT OR IGNORE INTO comit
+            (sha, message, size, created, content_sha, compiler_version, parents, file_id)
+        VALUES (?,?,?,?,?,?,?,?)
+        ''', rows)
     global sam_comit, total_sam_comit
-    sam_comit += 1
-    total_sam_comit += 1
-
-def known_repo(item):
-    cur = db.execute("select count(*) from repo where full_name = ? and repo_id = ?",
-        (item['full_name'], item['id']))
-    return cur.fetchone()[0] == 1
-
-def known_file(item, repo_id):
-    cur = db.execute("select count(*) from file where path = ? and repo_id = ?",
-        (item['path'], repo_id))
-    return cur.fetchone()[0] == 1
-    
-
-def known_commit(item, file_id):
-    cur = db.execute("select count(*) from comit where sha = ? and file_id = ?",
-        (item['sha'], file_id))
-    return cur.fetchone()[0] == 1
+    sam_comit += local_cur.rowcount
+    total_sam_comit += local_cur.rowcount
 
 # For convenience, we define a short function that uses a regex to get the 
 # compiler version of a Solidity file.
 
 def find_compiler_version(text):
     compiler_vers = ""
-    compiler_re = re.search(r'pragma solidity [<>^]?=?\s*([\d.]+)', text)
+    compiler_re = PRAGMA_RE.search(text)
     if compiler_re != None:
         compiler_vers = compiler_re.group(1)
     return compiler_vers
@@ -574,20 +1045,27 @@ else:
     with open(args.statistics, 'w') as f:
         f.write('stratum_first,stratum_last,population_repo,sample_repo,sample_file,sample_comit\n')
 
-statsfile = open(args.statistics, 'a', newline='')
+# The statistics rows are small and only written once per stratum, so we let
+# them sit in the file buffer and only force them to disk when the program
+# exits (see the signal handler and the end of the main loop).
+
+statsfile = open(args.statistics, 'a', newline='', buffering=8192)
 stats = csv.writer(statsfile)
 
 #-------------------------------------------------------------------------------
 
 # Let's also quickly define a signal handler to cleanly deal with Ctrl-C. If the
 # user quits the program and cancels the search, we want to allow him to later
-# continue more-or-less where he left of. So we need to properly close the
-# database and statistic file.
+# continue more-or-less where he left of. So we commit the database and flush
+# the statistic file. The handler can fire while a per-repo transaction block
+# is open, so the connection is deliberately not closed here: the enclosing
+# 'with db' block still runs its exit on the way out (a no-op after the
+# commit), and the interpreter releases the connection on exit anyway.
 
 def signal_handler(sig,frame):
     db.commit()
-    db.close()
     statsfile.flush()
+    os.fsync(statsfile.fileno())
     statsfile.close()
     print("\nThe program took " + time.strftime("%H:%M:%S", 
         time.gmtime((time.time())-start)) + " to execute (Hours:Minutes:Seconds).")
@@ -617,7 +1095,7 @@ while strat_first <= args.max_size:
 
         update_status('Searching...')
         res = search(strat_first, strat_last)
-        pop_repo = int(res.json()['total_count'])
+        pop_repo = int(orjson.loads(res.content)['total_count'])
         clear_footer()
         print_stratum(overwrite=True)
         print_footer()
@@ -637,7 +1115,7 @@ while strat_first <= args.max_size:
             # population count on the second query. We will take the maximum of the
             # two population counts for this stratum as a conservative estimate.
 
-            pop2 = int(res.json()['total_count'])
+            pop2 = int(orjson.loads(res.content)['total_count'])
             pop_repo = max(pop_repo,pop2)
             clear_footer()
             print_stratum(overwrite=True)
@@ -656,7 +1134,7 @@ while strat_first <= args.max_size:
             current_license = lic
             res = search(strat_first, strat_last,license=lic)
             current_cumulative_pop = pop_repo
-            pop_repo += int(res.json()['total_count'])
+            pop_repo += int(orjson.loads(res.content)['total_count'])
             clear_footer()
             print_stratum(overwrite=True)
             print_footer()
@@ -667,7 +1145,7 @@ while strat_first <= args.max_size:
                 update_status('Repeating search with reverse sort order...')
                 res = search(strat_first, strat_last, order='desc',license=lic)
 
-                pop2 = int(res.json()['total_count']) + current_cumulative_pop
+                pop2 = int(orjson.loads(res.content)['total_count']) + current_cumulative_pop
                 pop_repo = max(pop_repo,pop2)
                 clear_footer()
                 print_stratum(overwrite=True)
@@ -677,11 +1155,19 @@ while strat_first <= args.max_size:
 
 
     # After we've sampled as much as we could of the current strata, commit it
-    # to the table and move on to the next one.
+    # to the table and move on to the next one. We also make sure any database
+    # work that is still pending lands on disk before the stratum is recorded
+    # as done.
 
+    db.commit()
     stats.writerow([strat_first,strat_last,pop_repo,sam_repo,sam_file,sam_comit])
-    statsfile.flush()
-    
+
+    # Without a terminal there are no live redraws that could have shown this
+    # stratum's numbers, so emit the finished row exactly once before the
+    # counters are reset.
+    if not UI_TTY:
+        print_stratum()
+
     strat_first += args.stratum_size
     strat_last = min(strat_last + args.stratum_size, args.max_size)
     pop_repo = -1
@@ -690,10 +1176,16 @@ while strat_first <= args.max_size:
     sam_comit = -1
 
     clear_footer()
-    print_stratum()
+    if UI_TTY:
+        # On a terminal this opens the still empty row of the next stratum,
+        # which the live updates then overwrite.
+        print_stratum()
     print_footer()
 
 update_status('Done.')
+statsfile.flush()
+os.fsync(statsfile.fileno())
+statsfile.close()
 print("The program took " + time.strftime("%H:%M:%S", time.gmtime((time.time())-start)) + 
     " to execute (Hours:Minutes:Seconds).")
 print("The program has requested " + str(api_calls) + " API calls from GitHub.\n\n")